@@ -1,18 +1,40 @@
 # db.py
 import os
+import re
+import atexit
 import logging
 from contextlib import contextmanager
+from functools import cache, lru_cache
+from itertools import chain
 from dotenv import load_dotenv
 import psycopg
-from psycopg.rows import dict_row
+from psycopg.rows import dict_row, tuple_row
+from psycopg_pool import ConnectionPool
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
-load_dotenv()
+# .env is read lazily on the first DSN build so importing this module does
+# no filesystem work
+_DOTENV_LOADED = False
 
+def _load_dotenv_once():
+    global _DOTENV_LOADED
+    if not _DOTENV_LOADED:
+        load_dotenv()
+        _DOTENV_LOADED = True
+
+@cache
 def _build_dsn():
-    """Build PostgreSQL connection string from individual environment variables"""
+    """Build PostgreSQL connection string from PG_DSN or individual environment variables"""
+    _load_dotenv_once()
+
+    # A full DSN takes precedence over the individual parts
+    dsn = os.getenv("PG_DSN")
+    if dsn:
+        logger.debug("Using PG_DSN from environment")
+        return dsn
+
     host = os.getenv("DB_HOST")
     port = os.getenv("DB_PORT", "5432")
     user = os.getenv("DB_USER")
@@ -39,87 +61,295 @@ def _build_dsn():
     logger.debug(f"Database connection string configured: {dsn[:20]}...")
     return dsn
 
-# Get DSN - will be built when first accessed
-PG_DSN = None
+# _build_dsn is cached, so this is a thread-safe one-time build
+_get_dsn = _build_dsn
 
-def _get_dsn():
-    """Get DSN, building it if needed"""
-    global PG_DSN
-    if PG_DSN is None:
-        PG_DSN = _build_dsn()
-    return PG_DSN
+# Process-wide pool, created lazily on first use so imports stay cheap
+_POOL = None
 
-def _require_dsn():
-    """Ensure DSN is available"""
-    _get_dsn()
+def _get_pool() -> ConnectionPool:
+    """Get the shared connection pool, creating it on first use."""
+    global _POOL
+    if _POOL is None:
+        logger.debug("Creating process-wide connection pool")
+        # prepare_threshold=0 prepares every statement on first use, so the
+        # server caches the plan for the hot SQL reissued each run
+        _POOL = ConnectionPool(
+            conninfo=_get_dsn(),
+            min_size=2,
+            max_size=8,
+            kwargs={"row_factory": dict_row, "prepare_threshold": 0},
+        )
+        atexit.register(_POOL.close)
+    return _POOL
 
 @contextmanager
 def conn_cursor():
     """Yields (conn, cur) with dict rows; caller controls BEGIN/COMMIT."""
-    logger.debug("Creating database connection and cursor")
-    dsn = _get_dsn()
-    
+    logger.debug("Checking out database connection from pool")
+
     try:
-        with psycopg.connect(dsn, row_factory=dict_row) as conn:
-            logger.debug("Database connection established")
+        with _get_pool().connection() as conn:
+            logger.debug("Database connection checked out")
             with conn.cursor() as cur:
                 logger.debug("Database cursor created")
                 yield conn, cur
-                logger.debug("Database cursor and connection closed")
+                logger.debug("Database cursor closed, connection returned to pool")
     except Exception as e:
         logger.error(f"Database connection error: {e}")
         raise
 
+# Indexes backing the WHERE/JOIN columns used by the hot SQL in query.py.
+# BRIN suits the naturally-ordered append-only date columns; the INCLUDE
+# index makes the opening-balance read and the upsert conflict check
+# index-only.
+_BOOTSTRAP_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_vendor_purchases_purchase_date "
+    "ON store_data.vendor_purchases USING BRIN (purchase_date)",
+    "CREATE INDEX IF NOT EXISTS idx_sales_orders_clientcreatedtime "
+    "ON store_data.sales_orders USING BRIN (clientcreatedtime)",
+    "CREATE INDEX IF NOT EXISTS idx_sales_orders_line_items_order_id "
+    "ON store_data.sales_orders_line_items (order_id)",
+    "CREATE INDEX IF NOT EXISTS idx_vendor_purchases_line_items_docupanda_id "
+    "ON store_data.vendor_purchases_line_items (docupanda_id)",
+    "CREATE INDEX IF NOT EXISTS idx_ledger_date_item_onhand "
+    "ON syncstock.ledger (order_created_date, inventory_id) INCLUDE (on_hand_end)",
+]
+
+_indexes_bootstrapped = False
+
+def bootstrap_indexes(cur):
+    """Create the indexes the hot queries rely on; no-op after the first call."""
+    global _indexes_bootstrapped
+    if _indexes_bootstrapped:
+        logger.debug("Indexes already bootstrapped this process, skipping")
+        return
+
+    logger.debug(f"Bootstrapping {len(_BOOTSTRAP_INDEXES)} indexes")
+    for stmt in _BOOTSTRAP_INDEXES:
+        cur.execute(stmt)
+    _indexes_bootstrapped = True
+    logger.info(f"Bootstrapped {len(_BOOTSTRAP_INDEXES)} indexes")
+
+def copy_out(cur, select_sql: str, params=None, types=None):
+    """Stream a SELECT through binary COPY, yielding result tuples.
+
+    Skips the text-protocol encode/decode round trip for wide result sets;
+    pass the PostgreSQL type names of the selected columns via types so the
+    binary values are loaded into Python objects.
+    """
+    logger.debug(f"Streaming query via binary COPY: {select_sql[:80]}...")
+    with cur.copy(f"COPY ({select_sql}) TO STDOUT WITH (FORMAT BINARY)", params) as cp:
+        if types:
+            cp.set_types(types)
+        yield from cp.rows()
+
+@contextmanager
+def client_cursor(conn):
+    """Yields a ClientCursor, which quotes parameters client-side.
+
+    Statements built from mogrify'd rows go to the server as one simple
+    query with zero Bind round trips — the fastest non-COPY bulk path.
+    """
+    logger.debug("Creating client-side cursor")
+    with psycopg.ClientCursor(conn) as cur:
+        yield cur
+
+@contextmanager
+def named_cursor(conn, name: str, itersize: int = 10000, row_factory=None):
+    """Yields a server-side (named) cursor that streams rows in itersize chunks.
+
+    Iterating the cursor fetches from the server in batches, overlapping
+    server compute with client consumption and capping peak client memory,
+    instead of buffering the whole result set like fetchall(). Pass
+    row_factory=tuple_row for hot paths that read columns positionally.
+    """
+    logger.debug(f"Creating named server-side cursor '{name}' with itersize {itersize}")
+    with conn.cursor(name=name, row_factory=row_factory or conn.row_factory) as cur:
+        cur.itersize = itersize
+        yield cur
+
+@contextmanager
+def tuple_cursor(conn):
+    """Yields a cursor returning plain tuples instead of dict rows.
+
+    dict_row allocates a dict per row; tuple rows skip that, which matters
+    on bulk reads that only touch a few known columns positionally. Keep
+    dict rows for the one-row meta reads where ergonomics matter.
+    """
+    logger.debug("Creating tuple-row cursor")
+    with conn.cursor(row_factory=tuple_row) as cur:
+        yield cur
+
+@lru_cache(maxsize=64)
+def _placeholders(ncols: int, nrows: int) -> str:
+    """Return the '(%s,...),(%s,...)' VALUES template for a batch shape.
+
+    Cached per (ncols, nrows) so each distinct batch shape is built once
+    per process instead of once per batch.
+    """
+    row = '(' + ','.join(['%s'] * ncols) + ')'
+    return ','.join([row] * nrows)
+
+def _chunks(rows, size: int):
+    """Yield successive size-row slices of rows."""
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+def batched_execute(conn, cur, sql: str, rows, page_size: int = 1000):
+    """Run a per-row statement over many rows inside one pipeline.
+
+    Wraps executemany in conn.pipeline() so the Bind/Execute messages for
+    every batch stream back-to-back with a single Sync, instead of paying a
+    full round trip per batch. Use this for writer paths where COPY does
+    not apply (the statement is not a plain INSERT ... VALUES).
+    """
+    if not rows:
+        logger.debug("No rows to execute, skipping batched_execute")
+        return
+
+    logger.debug(f"Executing {len(rows)} rows in pipeline mode with page_size {page_size}")
+    with conn.pipeline():
+        for batch in _chunks(rows, page_size):
+            cur.executemany(sql, batch)
+    logger.info(f"Successfully executed {len(rows)} rows in pipeline mode")
+
+# Matches "INSERT INTO <table> (<columns>) VALUES %s" so we can route the
+# rows through COPY instead of building VALUES strings in Python. Anchored
+# to the start of the template: an INSERT embedded in a larger statement
+# (e.g. inside a CTE) must not be rerouted, or everything before it would
+# be silently dropped.
+_INSERT_VALUES_RE = re.compile(
+    r"\A\s*INSERT\s+INTO\s+([\w.]+)\s*\(([^)]+)\)\s*VALUES\s+%s",
+    re.IGNORECASE,
+)
+
+def _column_types(cur, table: str, columns):
+    """Return the type OID of each column, in order, for binary COPY.
+
+    Binary COPY applies no cast rule: each field must be dumped as the
+    exact column type, so the writer needs the real types up front.
+    """
+    with cur.connection.cursor(row_factory=tuple_row) as tcur:
+        tcur.execute(
+            "SELECT attname, atttypid FROM pg_catalog.pg_attribute "
+            "WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped",
+            (table,),
+        )
+        oid_by_name = dict(tcur.fetchall())
+    return [oid_by_name[c] for c in columns]
+
+def copy_insert(cur, table: str, columns, rows, types=None):
+    """Stream rows into a table with a single binary COPY.
+
+    types lists the column types (names or OIDs) for set_types; without it
+    psycopg picks a dumper per value (a small int dumps as int2), which the
+    server rejects when the column differs. Defaults to the catalog types.
+    """
+    cols = ", ".join(columns)
+    logger.debug(f"COPY {len(rows)} rows into {table} ({cols})")
+    if types is None:
+        types = _column_types(cur, table, columns)
+    with cur.copy(f"COPY {table} ({cols}) FROM STDIN WITH (FORMAT BINARY)") as cp:
+        cp.set_types(types)
+        for row in rows:
+            cp.write_row(row)
+    logger.info(f"Successfully copied {len(rows)} rows into {table}")
+
+def copy_upsert(cur, table: str, columns, rows, conflict_clause: str, types=None):
+    """COPY rows into a temp table, then upsert into the target in one statement."""
+    cols = ", ".join(columns)
+    tmp = "_copy_" + table.replace(".", "_")
+    logger.debug(f"Staging {len(rows)} rows in temp table {tmp} for upsert into {table}")
+    cur.execute(f"CREATE TEMP TABLE {tmp} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+    copy_insert(cur, tmp, columns, rows, types=types)
+    cur.execute(f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {tmp} {conflict_clause}")
+    cur.execute(f"DROP TABLE {tmp}")
+    logger.info(f"Successfully upserted {len(rows)} rows into {table} via COPY")
+
 def execute_values(cur, sql: str, rows, page_size: int = 1000):
-    """Use psycopg's native execute_values with proper chunking"""
+    """Bulk insert rows for an INSERT ... VALUES %s template.
+
+    Pure INSERT ... VALUES statements are streamed through a binary COPY
+    (one round trip, no Python-side SQL assembly). ON CONFLICT upserts are
+    COPYed into a temp table and folded in with a single INSERT ... SELECT.
+    Templates that don't parse fall back to the batched VALUES builder.
+    """
     if not rows:
         logger.debug("No rows to insert, skipping execute_values")
         return
-    
-    logger.debug(f"Executing bulk insert with {len(rows)} rows using page_size {page_size}")
-    logger.debug(f"SQL template: {sql}")
-    
-    try:
-        # Try to use psycopg's native execute_values if available
-        from psycopg.extras import execute_values as _ev
-        logger.debug("Using psycopg's native execute_values")
-        _ev(cur, sql, rows, page_size=page_size)
-        logger.info(f"Successfully inserted {len(rows)} rows using native execute_values")
-        
-    except ImportError:
-        # Fallback to custom implementation if psycopg.extras not available
-        logger.debug("psycopg.extras not available, using custom implementation")
-        
+
+    # Evaluate once so the hot loops below don't format strings that the
+    # logger would only discard
+    _dbg = logger.isEnabledFor(logging.DEBUG)
+    if _dbg:
+        logger.debug("Executing bulk insert with %s rows using page_size %s", len(rows), page_size)
+        logger.debug("SQL template: %s", sql)
+
+    m = _INSERT_VALUES_RE.search(sql)
+    if m:
+        table = m.group(1)
+        columns = [c.strip() for c in m.group(2).split(",")]
+        tail = sql[m.end():].strip()
+        if tail:
+            # ON CONFLICT (or similar) tail: stage via temp table
+            copy_upsert(cur, table, columns, rows, tail)
+        else:
+            copy_insert(cur, table, columns, rows)
+    else:
+        # Fallback to the Python-side VALUES builder if the template
+        # doesn't look like a plain INSERT ... VALUES %s
+        logger.debug("SQL template not COPY-compatible, using custom implementation")
+
         # Find the VALUES clause and replace only the %s there
         if 'VALUES %s' in sql:
+            # Keep page_size * ncols under PostgreSQL's 65535 bind-parameter
+            # limit, and cap at 10k rows where throughput plateaus anyway;
+            # the parameter limit always wins, even for very wide rows
+            ncols = len(rows[0])
+            effective = min(page_size, max(1, 65535 // ncols), 10000)
+            if effective < page_size:
+                logger.warning(f"Clamped page_size from {page_size} to {effective} ({ncols} columns per row)")
+            page_size = effective
+
             total_batches = (len(rows) + page_size - 1) // page_size
             logger.info(f"Processing {len(rows)} rows in {total_batches} batches of {page_size}")
-            
+
+            # Slice the template once instead of rescanning it per batch;
+            # per-batch work is then a single concatenation
+            idx = sql.find('VALUES %s')
+            prefix = sql[:idx] + 'VALUES '
+            suffix = sql[idx + len('VALUES %s'):]
+
+            # ClientCursor can render whole batches client-side, sending each
+            # as a single simple query with no Bind round trips
+            use_mogrify = hasattr(cur, 'mogrify')
+            row_tmpl = '(' + ','.join(['%s'] * ncols) + ')'
+
             for i in range(0, len(rows), page_size):
                 batch = rows[i:i + page_size]
-                batch_num = (i // page_size) + 1
-                
-                logger.debug(f"Processing batch {batch_num}/{total_batches} with {len(batch)} rows")
-                
-                # Create proper placeholders for this batch
-                placeholders = ','.join(['(' + ','.join(['%s'] * len(batch[0])) + ')'] * len(batch))
-                batch_sql = sql.replace('VALUES %s', f'VALUES {placeholders}')
-                
-                logger.debug(f"Batch {batch_num} SQL: {batch_sql[:100]}...")
-                
-                # Flatten the batch rows for execution
-                flat_rows = [item for row in batch for item in row]
-                logger.debug(f"Batch {batch_num} flattened to {len(flat_rows)} parameters")
-                
-                cur.execute(batch_sql, flat_rows)
-                logger.debug(f"Batch {batch_num} executed successfully")
-            
+
+                if _dbg:
+                    batch_num = (i // page_size) + 1
+                    logger.debug("Processing batch %s/%s with %s rows", batch_num, total_batches, len(batch))
+
+                if use_mogrify:
+                    rendered = ','.join(cur.mogrify(row_tmpl, row) for row in batch)
+                    cur.execute(prefix + rendered + suffix)
+                else:
+                    batch_sql = prefix + _placeholders(ncols, len(batch)) + suffix
+
+                    # Flatten the batch rows for execution
+                    flat_rows = list(chain.from_iterable(batch))
+
+                    cur.execute(batch_sql, flat_rows)
+
             logger.info(f"Successfully inserted {len(rows)} rows in {total_batches} batches using custom implementation")
         else:
-            logger.debug("No VALUES clause found, executing rows individually")
+            if _dbg:
+                logger.debug("No VALUES clause found, executing rows individually")
             # Fallback: execute each row individually
-            for i, row in enumerate(rows):
-                logger.debug(f"Executing row {i+1}/{len(rows)}: {row}")
+            for row in rows:
                 cur.execute(sql, row)
-            
+
             logger.info(f"Successfully inserted {len(rows)} rows individually")
\ No newline at end of file
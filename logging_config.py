@@ -28,7 +28,16 @@ def setup_logging(
     """
     # Convert string level to logging constant
     numeric_level = getattr(logging, level.upper(), logging.INFO)
-    
+
+    # Short-circuit if an equivalent setup already ran (e.g. in a parent
+    # process or another importing module) — avoids rebuilding handlers
+    root_logger = logging.getLogger()
+    if not log_file and any(
+        isinstance(h, logging.StreamHandler) and h.level == numeric_level
+        for h in root_logger.handlers
+    ):
+        return logging.getLogger(__name__ if __name__ != '__main__' else 'main')
+
     # Default format if none provided
     if format_string is None:
         format_string = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
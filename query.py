@@ -4,32 +4,25 @@ import logging
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# SQL lives in module-level constants so callers get the interned string
+# for free; the sql_*() wrappers remain for existing call sites.
+
 # --- meta / watermarks ---
-def sql_get_last_sales_day():
-    logger.debug("Generating SQL: get last sales day watermark")
-    return "SELECT last_sales_day_done AS d FROM syncstock.meta WHERE id=TRUE"
+SQL_GET_LAST_SALES_DAY = "SELECT last_sales_day_done AS d FROM syncstock.meta WHERE id=TRUE"
 
-def sql_set_status():
-    logger.debug("Generating SQL: set status")
-    return "UPDATE syncstock.meta SET run_status=%s, notes=COALESCE(%s, notes), updated_at=now() WHERE id=TRUE"
+SQL_SET_STATUS = "UPDATE syncstock.meta SET run_status=%s, notes=COALESCE(%s, notes), updated_at=now() WHERE id=TRUE"
 
-def sql_advance_sales_day_watermark():
-    logger.debug("Generating SQL: advance sales day watermark")
-    # set watermark to the last fully processed day
-    return "UPDATE syncstock.meta SET last_sales_day_done=%s, run_status='SUCCESS', updated_at=now() WHERE id=TRUE"
+# set watermark to the last fully processed day
+SQL_ADVANCE_SALES_DAY_WATERMARK = "UPDATE syncstock.meta SET last_sales_day_done=%s, run_status='SUCCESS', updated_at=now() WHERE id=TRUE"
 
-def sql_now():
-    logger.debug("Generating SQL: get current time and date")
-    return "SELECT now() AS now, current_date AS today"
+SQL_NOW = "SELECT now() AS now, current_date AS today"
 
 # --- daily aggregates in [start_day, end_day) ---
-def sql_daily_purchases():
-    logger.debug("Generating SQL: daily purchases aggregation")
-    # uses vendor receipt/purchase date
-    return """
+# uses vendor receipt/purchase date
+SQL_DAILY_PURCHASES = """
     SELECT DATE(vp.purchase_date) AS day,
            ii.id::text           AS inventory_id,
-           SUM(li.quantity)::int AS purchased_qty
+           COALESCE(SUM(li.quantity), 0)::int AS purchased_qty
     FROM store_data.vendor_purchases vp
     JOIN store_data.vendor_purchases_line_items li ON li.docupanda_id = vp.docupanda_id
     LEFT JOIN store_data.vendor_items vi ON li.upc = vi.receipt_upc
@@ -41,38 +34,115 @@ def sql_daily_purchases():
     ORDER BY 1,2
     """
 
-def sql_daily_sales():
-    logger.debug("Generating SQL: daily sales aggregation")
-    # uses sales order created time
-    return """
+# uses sales order created time
+SQL_DAILY_SALES = """
     SELECT DATE(so.clientcreatedtime) AS day,
            sol.item_id::text          AS inventory_id,
-           SUM(COALESCE(NULLIF(sol.unitqty,0), sol.quantity)
-               * CASE WHEN COALESCE(sol.refunded, FALSE) THEN -1 ELSE 1 END)::int AS sold_qty
+           COALESCE(SUM(COALESCE(NULLIF(sol.unitqty,0), sol.quantity)
+               * CASE WHEN COALESCE(sol.refunded, FALSE) THEN -1 ELSE 1 END), 0)::int AS sold_qty
     FROM store_data.sales_orders_line_items sol
     JOIN store_data.sales_orders so ON so.id = sol.order_id
+    JOIN store_data.inventory_items ii ON ii.id = sol.item_id::text
     WHERE sol.item_id IS NOT NULL
-      AND so.clientcreatedtime >= %s AND so.clientcreatedtime < %s
+      AND so.clientcreatedtime >= %s::timestamp AND so.clientcreatedtime < %s::timestamp
     GROUP BY 1,2
     ORDER BY 1,2
     """
 
-# --- opening balance for the first day (yesterday's closing) ---
-def sql_opening_on_hand_prev_day():
-    logger.debug("Generating SQL: get opening balances from previous day")
-    return """
-    SELECT inventory_id, on_hand_end
+# --- fused daily rollup: purchases + sales + running balance in one statement ---
+# Emits (day, inventory_id, purchased_qty, sold_qty, on_hand_end) directly:
+# one round trip, with the running balance computed in-DB by a window SUM
+# seeded from the prior day's closing ledger rows.
+# Params: (start, end) purchases, (start, end) sales, (start) opening.
+SQL_DAILY_LEDGER_ROWS = """
+    WITH p AS (
+        SELECT DATE(vp.purchase_date) AS day,
+               ii.id::text           AS inventory_id,
+               COALESCE(SUM(li.quantity), 0)::int AS purchased_qty
+        FROM store_data.vendor_purchases vp
+        JOIN store_data.vendor_purchases_line_items li ON li.docupanda_id = vp.docupanda_id
+        LEFT JOIN store_data.vendor_items vi ON li.upc = vi.receipt_upc
+        LEFT JOIN store_data.item_mapping im ON vi.id = im.vendor_item_id
+        LEFT JOIN store_data.inventory_items ii ON ii.id = im.inventory_item_id
+        WHERE ii.id IS NOT NULL
+          AND vp.purchase_date >= %s AND vp.purchase_date < %s
+        GROUP BY 1,2
+    ), s AS (
+        SELECT DATE(so.clientcreatedtime) AS day,
+               sol.item_id::text          AS inventory_id,
+               COALESCE(SUM(COALESCE(NULLIF(sol.unitqty,0), sol.quantity)
+                   * CASE WHEN COALESCE(sol.refunded, FALSE) THEN -1 ELSE 1 END), 0)::int AS sold_qty
+        FROM store_data.sales_orders_line_items sol
+        JOIN store_data.sales_orders so ON so.id = sol.order_id
+        JOIN store_data.inventory_items ii ON ii.id = sol.item_id::text
+        WHERE sol.item_id IS NOT NULL
+          AND so.clientcreatedtime >= %s::timestamp AND so.clientcreatedtime < %s::timestamp
+        GROUP BY 1,2
+    ), base AS (
+        SELECT COALESCE(p.day, s.day)                   AS day,
+               COALESCE(p.inventory_id, s.inventory_id) AS inventory_id,
+               COALESCE(p.purchased_qty, 0)             AS purchased_qty,
+               COALESCE(s.sold_qty, 0)                  AS sold_qty
+        FROM p FULL OUTER JOIN s USING (day, inventory_id)
+    ), opening AS (
+        SELECT DISTINCT ON (inventory_id) inventory_id, on_hand_end
+        FROM syncstock.ledger
+        WHERE order_created_date < %s::date
+        ORDER BY inventory_id, order_created_date DESC
+    )
+    SELECT base.day,
+           base.inventory_id,
+           base.purchased_qty,
+           base.sold_qty,
+           COALESCE((SELECT o.on_hand_end FROM opening o
+                     WHERE o.inventory_id = base.inventory_id), 0)
+           + SUM(base.purchased_qty - base.sold_qty)
+             OVER (PARTITION BY base.inventory_id ORDER BY base.day) AS on_hand_end
+    FROM base
+    ORDER BY 1,2
+    """
+
+# --- opening balance for the first day (each item's latest prior closing) ---
+# the ledger is sparse (quiet days write no row), so take the newest row
+# per item before the window instead of requiring an exact previous day
+SQL_OPENING_ON_HAND_PREV_DAY = """
+    SELECT DISTINCT ON (inventory_id) inventory_id, on_hand_end
     FROM syncstock.ledger
-    WHERE order_created_date = %s::date - INTERVAL '1 day'
+    WHERE order_created_date < %s::date
       AND inventory_id = ANY(%s::text[])
+    ORDER BY inventory_id, order_created_date DESC
     """
 
 # --- writers ---
-def sql_upsert_ledger():
-    logger.debug("Generating SQL: upsert daily ledger entries")
-    return """
+LEDGER_COLUMNS = ["order_created_date", "inventory_id", "purchased_qty", "sold_qty", "on_hand_end"]
+
+# column types for binary COPY of ledger rows (set_types needs the exact
+# column types; value-driven dumpers would pick int2 for small quantities)
+LEDGER_COLUMN_TYPES = ["date", "text", "int4", "int4", "int4"]
+
+SQL_LEDGER_CONFLICT_CLAUSE = """
+    ON CONFLICT (order_created_date, inventory_id) DO UPDATE
+    SET purchased_qty = EXCLUDED.purchased_qty,
+        sold_qty      = EXCLUDED.sold_qty,
+        on_hand_end   = EXCLUDED.on_hand_end,
+        computed_at   = now()
+    """
+
+# clear the reprocessed window before upserting: the ledger is sparse, so
+# a (day, item) cell that produced a row in an earlier run but nets to
+# zero now (edited or offsetting source rows) emits nothing — without the
+# delete its stale row would survive and be served as the item's latest
+# balance
+SQL_DELETE_LEDGER_WINDOW = """
+    DELETE FROM syncstock.ledger
+    WHERE order_created_date >= %s AND order_created_date < %s
+    """
+
+# one Parse/Bind/Execute for any number of rows: parameters arrive as
+# five parallel arrays, sidestepping the 65535-parameter limit
+SQL_UPSERT_LEDGER = """
     INSERT INTO syncstock.ledger (order_created_date, inventory_id, purchased_qty, sold_qty, on_hand_end)
-    VALUES %s
+    SELECT * FROM unnest(%s::date[], %s::text[], %s::int[], %s::int[], %s::int[])
     ON CONFLICT (order_created_date, inventory_id) DO UPDATE
     SET purchased_qty = EXCLUDED.purchased_qty,
         sold_qty      = EXCLUDED.sold_qty,
@@ -80,21 +150,76 @@ def sql_upsert_ledger():
         computed_at   = now()
     """
 
-def sql_upsert_stock_from_latest_day():
-    logger.debug("Generating SQL: update current stock from latest ledger day")
-    # take the latest processed day's on_hand_end as current stock
-    return """
+# folds the watermark/status update into the same statement as the
+# ledger upsert: one round trip, and the watermark cannot advance
+# unless the ledger write succeeds
+SQL_FINALIZE_DAY = """
+    WITH upserts AS (
+        INSERT INTO syncstock.ledger (order_created_date, inventory_id, purchased_qty, sold_qty, on_hand_end)
+        SELECT * FROM unnest(%s::date[], %s::text[], %s::int[], %s::int[], %s::int[])
+        ON CONFLICT (order_created_date, inventory_id) DO UPDATE
+        SET purchased_qty = EXCLUDED.purchased_qty,
+            sold_qty      = EXCLUDED.sold_qty,
+            on_hand_end   = EXCLUDED.on_hand_end,
+            computed_at   = now()
+        RETURNING 1
+    )
+    UPDATE syncstock.meta
+    SET last_sales_day_done=%s, run_status='SUCCESS', updated_at=now()
+    WHERE id=TRUE AND (SELECT COUNT(*) FROM upserts) >= 0
+    """
+
+# take each item's latest ledger row as current stock (the ledger is
+# sparse, so items can have different latest days)
+SQL_UPSERT_STOCK_FROM_LATEST_DAY = """
     INSERT INTO syncstock.stock (inventory_id, on_hand, updated_at, version)
     SELECT l.inventory_id,
            l.on_hand_end,
            now(),
            COALESCE(s.version,0)+1
-    FROM syncstock.ledger l
-    JOIN (SELECT MAX(order_created_date) AS d FROM syncstock.ledger) last ON true
+    FROM (SELECT DISTINCT ON (inventory_id) inventory_id, on_hand_end
+          FROM syncstock.ledger
+          ORDER BY inventory_id, order_created_date DESC) l
     LEFT JOIN syncstock.stock s ON s.inventory_id = l.inventory_id
-    WHERE l.order_created_date = last.d
     ON CONFLICT (inventory_id) DO UPDATE
     SET on_hand   = EXCLUDED.on_hand,
         updated_at= now(),
         version   = syncstock.stock.version + 1
-    """
\ No newline at end of file
+    """
+
+# --- thin wrappers for existing call sites ---
+def sql_get_last_sales_day():
+    return SQL_GET_LAST_SALES_DAY
+
+def sql_set_status():
+    return SQL_SET_STATUS
+
+def sql_advance_sales_day_watermark():
+    return SQL_ADVANCE_SALES_DAY_WATERMARK
+
+def sql_now():
+    return SQL_NOW
+
+def sql_daily_purchases():
+    return SQL_DAILY_PURCHASES
+
+def sql_daily_sales():
+    return SQL_DAILY_SALES
+
+def sql_daily_ledger_rows():
+    return SQL_DAILY_LEDGER_ROWS
+
+def sql_opening_on_hand_prev_day():
+    return SQL_OPENING_ON_HAND_PREV_DAY
+
+def sql_delete_ledger_window():
+    return SQL_DELETE_LEDGER_WINDOW
+
+def sql_upsert_ledger():
+    return SQL_UPSERT_LEDGER
+
+def sql_finalize_day():
+    return SQL_FINALIZE_DAY
+
+def sql_upsert_stock_from_latest_day():
+    return SQL_UPSERT_STOCK_FROM_LATEST_DAY
@@ -35,4 +35,15 @@ CREATE INDEX IF NOT EXISTS idx_ledger_date ON syncstock.ledger(order_created_dat
 -- Ensure the meta row exists
 INSERT INTO syncstock.meta (id, run_status, notes)
 VALUES (TRUE, 'INITIALIZED', 'Schema created')
-ON CONFLICT (id) DO NOTHING;
\ No newline at end of file
+ON CONFLICT (id) DO NOTHING;
+-- Indexes backing the hot queries (also ensured at runtime by db.bootstrap_indexes)
+CREATE INDEX IF NOT EXISTS idx_vendor_purchases_purchase_date
+  ON store_data.vendor_purchases USING BRIN (purchase_date);
+CREATE INDEX IF NOT EXISTS idx_sales_orders_clientcreatedtime
+  ON store_data.sales_orders USING BRIN (clientcreatedtime);
+CREATE INDEX IF NOT EXISTS idx_sales_orders_line_items_order_id
+  ON store_data.sales_orders_line_items (order_id);
+CREATE INDEX IF NOT EXISTS idx_vendor_purchases_line_items_docupanda_id
+  ON store_data.vendor_purchases_line_items (docupanda_id);
+CREATE INDEX IF NOT EXISTS idx_ledger_date_item_onhand
+  ON syncstock.ledger (order_created_date, inventory_id) INCLUDE (on_hand_end);
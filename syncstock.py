@@ -5,7 +5,9 @@ from typing import Dict, List, Tuple, Optional
 import json
 import sys
 import logging
-from db import conn_cursor, execute_values
+import numpy as np
+from db import conn_cursor, named_cursor, bootstrap_indexes, copy_out, copy_upsert
+from psycopg.rows import tuple_row
 import query as Q
 
 # Configure logging
@@ -16,6 +18,17 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Above this many ledger rows (deep backfills), stage the batch via binary
+# COPY into a temp table instead of binding five large arrays — COPY moves
+# bulk data faster than any parameterized statement.
+LEDGER_COPY_THRESHOLD = 50_000
+
+# hoisted: built once instead of once per use in the window math
+_ONE_DAY = timedelta(days=1)
+
+# cap on how many inventory ids bind into one opening-balance array
+OPENING_CHUNK = 10_000
+
 def pick_window(cur, user_lookback_start: Optional[date]) -> Tuple[date, date, int]:
     # today for end bound (exclusive)
     cur.execute(Q.sql_now()); nowrow = cur.fetchone() or {}
@@ -35,157 +48,125 @@ def pick_window(cur, user_lookback_start: Optional[date]) -> Tuple[date, date, i
         logger.info(f"Using default {lookback_days}-day lookback from: {start}")
     
     # include today; end is exclusive (process [start, end))
-    end = today + timedelta(days=1)
+    end = today + _ONE_DAY
     
     logger.info(f"Processing window: {start} to {end} ({(end - start).days} days)")
     return start, end, lookback_days
 
-def fetch_daily(cur, start: date, end: date):
+def fetch_daily(conn, start: date, end: date):
+    """Stream the daily aggregates straight into the merge maps.
+
+    The named cursors fetch in itersize batches and each row is folded
+    into its map as it arrives, so peak memory is one batch per query
+    instead of both full result sets, and merge work overlaps the
+    network fetch.
+    """
     logger.debug(f"Fetching daily data from {start} to {end}")
-    
+
+    # evaluated once so the per-row f-strings below cost nothing at INFO
+    _dbg = logger.isEnabledFor(logging.DEBUG)
+
+    # two flat int maps keyed by (day, iid): no nested-dict construction or
+    # lambda factory on first touch, and a single lookup per access.
+    # Rows arrive ready to use — ids cast to ::text and sums COALESCEd to
+    # int server-side — and tuple rows skip the per-row dict construction.
+    p_by = defaultdict(int)
+    s_by = defaultdict(int)
+
     logger.debug("Executing daily purchases query")
-    cur.execute(Q.sql_daily_purchases(), (start, end)); p = list(cur.fetchall())
-    logger.debug(f"Found {len(p)} purchase records")
-    
+    with named_cursor(conn, "daily_purchases", row_factory=tuple_row) as scur:
+        scur.execute(Q.sql_daily_purchases(), (start, end))
+        for d, iid, qty in scur:
+            p_by[(d,iid)] += qty
+            if _dbg and qty > 0:
+                logger.debug(f"Purchase: {d} - {iid} = +{qty}")
+
     logger.debug("Executing daily sales query")
-    cur.execute(Q.sql_daily_sales(), (start, end)); s = list(cur.fetchall())
-    logger.debug(f"Found {len(s)} sales records")
-    
-    # Validate that all inventory IDs exist in inventory_items table
-    logger.debug("Validating inventory IDs against inventory_items table")
-
-    # Get all unique inventory IDs from both datasets
-    all_ids = set()
-    for row in p:
-        if row["inventory_id"]:
-            all_ids.add(row["inventory_id"])
-    for row in s:
-        if row["inventory_id"]:
-            all_ids.add(row["inventory_id"])
-    
-    logger.debug(f"Found {len(all_ids)} unique inventory IDs to validate")
-    
-    # Check which IDs exist in inventory_items
-    if all_ids:
-        # Convert to list for SQL IN clause
-        id_list = list(all_ids)
-        # Split into chunks to avoid SQL parameter limits
-        chunk_size = 1000
-        valid_ids = set()
-        
-        for i in range(0, len(id_list), chunk_size):
-            chunk = id_list[i:i + chunk_size]
-            placeholders = ','.join(['%s'] * len(chunk))
-            cur.execute(f"SELECT id FROM store_data.inventory_items WHERE id IN ({placeholders})", chunk)
-            chunk_valid = {row['id'] for row in cur.fetchall()}
-            valid_ids.update(chunk_valid)
-        
-        logger.info(f"Validation complete: {len(valid_ids)} valid IDs out of {len(all_ids)} total")
-        
-        # Filter out invalid records
-        p_filtered = [row for row in p if row["inventory_id"] in valid_ids]
-        s_filtered = [row for row in s if row["inventory_id"] in valid_ids]
-        
-        invalid_count = len(p) + len(s) - len(p_filtered) - len(s_filtered)
-        if invalid_count > 0:
-            logger.warning(f"Filtered out {invalid_count} records with invalid inventory IDs")
-        
-        return p_filtered, s_filtered
-    
-    return p, s
+    with named_cursor(conn, "daily_sales", row_factory=tuple_row) as scur:
+        scur.execute(Q.sql_daily_sales(), (start, end))
+        for d, iid, qty in scur:
+            s_by[(d,iid)] += qty
+            if _dbg and qty > 0:
+                logger.debug(f"Sale: {d} - {iid} = -{qty}")
 
-def merge_daily(p_rows: List[dict], s_rows: List[dict]):
-    logger.debug("Merging daily purchase and sales data")
-    
-    by = defaultdict(lambda: {"p":0, "s":0})
-    items = set()
-    
-    logger.debug(f"Processing {len(p_rows)} purchase rows")
-    for r in p_rows:
-        d, iid = r["day"], str(r["inventory_id"])
-        # Handle NULL values safely
-        raw_qty = r["purchased_qty"]
-        if raw_qty is None:
-            logger.warning(f"NULL purchased_qty found for {iid} on {d}, treating as 0")
-            qty = 0
-        else:
-            qty = int(raw_qty)
-        
-        by[(d,iid)]["p"] += qty
-        items.add(iid)
-        if qty > 0:
-            logger.debug(f"Purchase: {d} - {iid} = +{qty}")
-    
-    logger.debug(f"Processing {len(s_rows)} sales rows")
-    for r in s_rows:
-        d, iid = r["day"], str(r["inventory_id"])
-        # Handle NULL values safely
-        raw_qty = r["sold_qty"]
-        if raw_qty is None:
-            logger.warning(f"NULL sold_qty found for {iid} on {d}, treating as 0")
-            qty = 0
-        else:
-            qty = int(raw_qty)
-        
-        by[(d,iid)]["s"] += qty
-        items.add(iid)
-        if qty > 0:
-            logger.debug(f"Sale: {d} - {iid} = -{qty}")
-    
-    logger.info(f"Merged data: {len(by)} unique (day, item) combinations, {len(items)} unique items")
-    return by, sorted(items)
+    # the item set is already encoded in the map keys — derive it once at
+    # the end instead of paying a set.add per input row
+    items = sorted({iid for _, iid in p_by} | {iid for _, iid in s_by})
+
+    logger.info(f"Merged data: {len(p_by)} purchase and {len(s_by)} sale (day, item) combinations, {len(items)} unique items")
+    return p_by, s_by, items
 
-def opening_balances(cur, start: date, items: List[str]) -> Dict[str,int]:
+def opening_balances(cur, start: date, items: List[str], item_idx: Dict[str,int]) -> np.ndarray:
+    """Return the opening balance per item as a vector aligned to item_idx.
+
+    Items with no prior ledger row open at 0. An index-aligned array
+    instead of a dict keyed by id means downstream stages index by
+    position and never re-hash the id strings.
+    """
     logger.debug(f"Getting opening balances for {len(items)} items from {start}")
-    
+
+    opening = np.zeros(len(items), dtype=np.int32)
     if not items:
         logger.debug("No items to get opening balances for")
-        return {}
-    
-    cur.execute(Q.sql_opening_on_hand_prev_day(), (start, items))
-    balances = {str(r["inventory_id"]): int(r["on_hand_end"]) for r in cur.fetchall()}
-    
-    logger.debug(f"Found opening balances for {len(balances)} items")
-    for item_id, balance in list(balances.items())[:5]:  # Log first 5 for debugging
-        logger.debug(f"Opening balance: {item_id} = {balance}")
-    
-    return balances
+        return opening
+
+    # binary COPY skips the text-protocol round trip for this potentially
+    # wide read; columns come back as (inventory_id, on_hand_end) tuples.
+    # The ids bind as one text[] parameter; chunk it so a huge catalog
+    # doesn't push a multi-megabyte array through a single Bind message.
+    found = 0
+    for i in range(0, len(items), OPENING_CHUNK):
+        for iid, on_hand_end in copy_out(
+            cur, Q.sql_opening_on_hand_prev_day(),
+            (start, items[i:i + OPENING_CHUNK]), types=["text", "int4"]
+        ):
+            opening[item_idx[iid]] = on_hand_end
+            found += 1
+
+    logger.debug(f"Found opening balances for {found} items")
 
-def roll_forward(start: date, end: date, items: List[str], by: dict, opening: Dict[str,int]):
+    return opening
+
+def roll_forward(start: date, end: date, items: List[str], item_idx: Dict[str,int],
+                 p_by: dict, s_by: dict, opening: np.ndarray):
     logger.debug(f"Rolling forward balances from {start} to {end} for {len(items)} items")
-    
+
+    ndays = (end - start).days
+    if ndays <= 0 or not items:
+        logger.info("Nothing to roll forward")
+        return []
+
+    days = [start + _ONE_DAY * i for i in range(ndays)]
+
+    # Scatter the sparse activity into (days, items) delta matrices, then
+    # compute every running balance with one vectorized cumulative sum —
+    # the prefix-sum runs in C instead of one Python iteration per cell.
+    pmat = np.zeros((ndays, len(items)), dtype=np.int32)
+    smat = np.zeros((ndays, len(items)), dtype=np.int32)
+    for (day, iid), qty in p_by.items():
+        pmat[(day - start).days, item_idx[iid]] = qty
+    for (day, iid), qty in s_by.items():
+        smat[(day - start).days, item_idx[iid]] = qty
+
+    on_hand = np.cumsum(pmat - smat, axis=0, dtype=np.int32) + opening
+
+    # The ledger is sparse: emit only cells with activity, plus one row per
+    # item on the first day so every item carries its balance into the
+    # window. The opening-balance and current-stock queries read the latest
+    # row per item, so gaps are fine.
+    emit = (pmat != 0) | (smat != 0)
+    emit[0, :] = True
+
     rows = []
-    on_hand = {iid: opening.get(iid, 0) for iid in items}
-    
-    logger.debug(f"Initial on-hand balances: {sum(on_hand.values())} total across {len(on_hand)} items")
-    
-    day = start
-    day_count = 0
-    while day < end:
-        day_count += 1
-        logger.debug(f"Processing day {day_count}: {day}")
-        
-        daily_changes = 0
-        for iid in items:
-            p = by.get((day, iid), {}).get("p", 0)
-            s = by.get((day, iid), {}).get("s", 0)
-            old_balance = on_hand[iid]
-            on_hand[iid] = old_balance + p - s
-            
-            if p > 0 or s > 0:
-                logger.debug(f"  {iid}: {old_balance} + {p} - {s} = {on_hand[iid]}")
-                daily_changes += 1
-            
-            rows.append((day, iid, p, s, on_hand[iid]))
-        
-        if daily_changes > 0:
-            logger.debug(f"Day {day}: {daily_changes} items had activity")
-        
-        day += timedelta(days=1)
-    
-    logger.info(f"Rolled forward {day_count} days, created {len(rows)} ledger rows")
-    logger.debug(f"Final on-hand balances: {sum(on_hand.values())} total across {len(on_hand)} items")
-    
+    for di, day in enumerate(days):
+        idx = np.nonzero(emit[di])[0]
+        if not idx.size:
+            continue
+        rows.extend(zip([day] * idx.size, [items[i] for i in idx.tolist()],
+                        pmat[di, idx].tolist(), smat[di, idx].tolist(), on_hand[di, idx].tolist()))
+
+    logger.info(f"Rolled forward {ndays} days, created {len(rows)} ledger rows (of {ndays * len(items)} cells)")
+
     return rows
 
 def run_daily_rollup(user_lookback_start: Optional[date] = None, is_webhook: bool = False):
@@ -218,8 +199,21 @@ def run_daily_rollup(user_lookback_start: Optional[date] = None, is_webhook: boo
             return
         
         logger.debug("Advisory lock acquired successfully")
-        
+
         try:
+            # Best-effort: the role may lack CREATE on store_data, or the
+            # SHARE lock may be unavailable on the live tables. A failed
+            # bootstrap must not abort the rollup — roll back (advisory
+            # locks survive rollback) and run on whatever indexes exist;
+            # schema.sql carries the same DDL for proper migration.
+            try:
+                logger.debug("Ensuring supporting indexes exist")
+                bootstrap_indexes(cur)
+                conn.commit()
+            except Exception as e:
+                logger.warning(f"Index bootstrap failed, continuing without: {e}")
+                conn.rollback()
+
             start, end, lookback_days = pick_window(cur, user_lookback_start)
             logger.info(f"   Processing date range: {start} to {end}")
             
@@ -227,36 +221,73 @@ def run_daily_rollup(user_lookback_start: Optional[date] = None, is_webhook: boo
                 logger.info("   No new data to process")
                 return
             
-            logger.debug("Fetching daily aggregates")
-            p_rows, s_rows = fetch_daily(cur, start, end)
-            logger.info(f"   Found {len(p_rows)} purchase records, {len(s_rows)} sales records")
-            
-            logger.debug("Merging daily data")
-            by, items = merge_daily(p_rows, s_rows)
-            
-            logger.debug("Getting opening balances")
-            opening = opening_balances(cur, start, items)
-            
-            logger.debug("Rolling forward balances")
-            ledger_rows = roll_forward(start, end, items, by, opening)
+            if os.getenv("SYNCSTOCK_SQL_ROLLUP", "0") == "1":
+                # Fused in-DB path: one round trip computes deltas and the
+                # running balance via a window SUM. Emits only active
+                # (day, item) rows.
+                logger.debug("Computing ledger rows in-database (SYNCSTOCK_SQL_ROLLUP=1)")
+                cur.execute(Q.sql_daily_ledger_rows(), (start, end, start, end, start))
+                ledger_rows = [
+                    (r["day"], r["inventory_id"], r["purchased_qty"], r["sold_qty"], r["on_hand_end"])
+                    for r in cur.fetchall()
+                ]
+                logger.info(f"   Computed {len(ledger_rows)} ledger rows in-database")
+            else:
+                logger.debug("Fetching and merging daily aggregates")
+                p_by, s_by, items = fetch_daily(conn, start, end)
+
+                # one id→index map for the whole run: opening_balances and
+                # roll_forward share it instead of re-hashing the id strings
+                item_idx = {iid: i for i, iid in enumerate(items)}
+
+                logger.debug("Getting opening balances")
+                opening = opening_balances(cur, start, items, item_idx)
+
+                if (end - start).days == 1:
+                    # single-day window — the common scheduled run resuming
+                    # from the watermark: one row per active item straight
+                    # from the merge maps, no day-grid to build
+                    logger.debug("Single-day window, emitting rows directly")
+                    ledger_rows = []
+                    for i, iid in enumerate(items):
+                        p = p_by.get((start, iid), 0)
+                        s = s_by.get((start, iid), 0)
+                        ledger_rows.append((start, iid, p, s, int(opening[i]) + p - s))
+                else:
+                    logger.debug("Rolling forward balances")
+                    ledger_rows = roll_forward(start, end, items, item_idx, p_by, s_by, opening)
             
             logger.info(f"   Creating {len(ledger_rows)} daily ledger entries")
             
             logger.debug("Starting database transaction")
             conn.execute("BEGIN")
-            
+
             try:
+                # drop whatever an earlier run wrote for this window so
+                # cells that no longer emit (activity edited away or
+                # netted to zero) don't survive as stale latest rows
+                logger.debug(f"Clearing ledger window {start} to {end}")
+                cur.execute(Q.sql_delete_ledger_window(), (start, end))
+
                 if ledger_rows:
-                    logger.debug("Inserting ledger records")
-                    execute_values(cur, Q.sql_upsert_ledger(), ledger_rows)
-                    logger.info(f"   ✅ Inserted {len(ledger_rows)} ledger records")
-                    
-                    # mark watermark to lookback days ago from today (always)
+                    logger.debug("Inserting ledger records and advancing watermark")
                     watermark_date = date.today() - timedelta(days=lookback_days)
-                    logger.debug(f"Setting watermark to {lookback_days} days ago: {watermark_date}")
-                    cur.execute(Q.sql_advance_sales_day_watermark(), (watermark_date,))
+                    if len(ledger_rows) >= LEDGER_COPY_THRESHOLD:
+                        # deep backfill: stream the rows via binary COPY into
+                        # a temp table and upsert from there in one statement
+                        copy_upsert(cur, "syncstock.ledger", Q.LEDGER_COLUMNS,
+                                    ledger_rows, Q.SQL_LEDGER_CONFLICT_CLAUSE,
+                                    types=Q.LEDGER_COLUMN_TYPES)
+                        cur.execute(Q.sql_advance_sales_day_watermark(), (watermark_date,))
+                    else:
+                        # unnest-based upsert takes five parallel arrays, and
+                        # the same statement advances the watermark — it can't
+                        # move unless the ledger lands
+                        days, iids, purchased, sold, on_hand = (list(col) for col in zip(*ledger_rows))
+                        cur.execute(Q.sql_finalize_day(), (days, iids, purchased, sold, on_hand, watermark_date))
+                    logger.info(f"   ✅ Inserted {len(ledger_rows)} ledger records")
                     logger.info(f"   ✅ Set watermark to {watermark_date} ({lookback_days} days ago)")
-                    
+
                     # refresh current stock from latest day
                     logger.debug("Updating current stock from latest day")
                     cur.execute(Q.sql_upsert_stock_from_latest_day())
@@ -279,8 +310,14 @@ def run_daily_rollup(user_lookback_start: Optional[date] = None, is_webhook: boo
                 logger.info("   🔄 Transaction rolled back")
                 raise
         finally:
-            # Always release the advisory lock
+            # Always release the advisory lock. Roll back first: if anything
+            # above failed, the transaction is aborted and the unlock would
+            # raise instead of running — and with pooled connections the
+            # session-scoped lock would then survive the run and lock out
+            # every later one. Rollback does not release advisory locks, so
+            # this is safe on the success path too.
             logger.debug("Releasing advisory lock")
+            conn.rollback()
             cur.execute("SELECT pg_advisory_unlock( hashtext('syncstock-runlock') )")
     
     end_time = date.today()
@@ -296,39 +333,34 @@ def parse_webhook_payload(payload: str) -> Optional[date]:
     - JSON: {"start_date": "2025-08-01"} or {"start_date": null}
     - Date string: "2025-08-01"
     """
-    logger.debug(f"Parsing webhook payload: {payload}")
-    
-    if not payload or payload.strip() == "":
+    logger.debug("Parsing webhook payload: %s", payload)
+
+    # strip once, then dispatch on the first character: JSON payloads start
+    # with '{', everything else is treated as a bare date string — each
+    # branch returns, so nothing is ever parsed twice
+    payload = payload.strip() if payload else ""
+    if not payload:
         logger.debug("Empty payload, using default behavior")
         return None
-    
-    try:
-        # Try to parse as JSON first
-        data = json.loads(payload)
-        logger.debug(f"Parsed as JSON: {data}")
-        
-        if isinstance(data, dict) and "start_date" in data:
-            start_date_str = data["start_date"]
+
+    if payload[0] == "{":
+        try:
+            data = json.loads(payload)
+            start_date_str = data.get("start_date") if isinstance(data, dict) else None
             if start_date_str:
-                parsed_date = date.fromisoformat(start_date_str)
-                logger.debug(f"Extracted start_date from JSON: {parsed_date}")
-                return parsed_date
-            else:
-                logger.debug("start_date is null in JSON, using default behavior")
-                return None
-    except json.JSONDecodeError as e:
-        logger.debug(f"Not valid JSON: {e}")
-    
-    try:
-        # Try to parse as direct date string
-        parsed_date = date.fromisoformat(payload.strip())
-        logger.debug(f"Parsed as direct date string: {parsed_date}")
-        return parsed_date
-    except ValueError as e:
-        logger.debug(f"Not valid date string: {e}")
-    
+                return date.fromisoformat(start_date_str)
+            logger.debug("No usable start_date in JSON, using default behavior")
+            return None
+        except (json.JSONDecodeError, ValueError, TypeError) as e:
+            logger.debug("Not usable JSON: %s", e)
+    else:
+        try:
+            return date.fromisoformat(payload)
+        except ValueError as e:
+            logger.debug("Not valid date string: %s", e)
+
     logger.warning(f"⚠️  Could not parse webhook payload: {payload}")
-    logger.warning(f"   Expected formats: empty string, JSON with 'start_date', or ISO date string")
+    logger.warning("   Expected formats: empty string, JSON with 'start_date', or ISO date string")
     return None
 
 if __name__ == "__main__":